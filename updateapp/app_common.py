@@ -15,15 +15,61 @@
 # mappings into the datastore is to prepare a file with a suitable Python data
 # literal I can import, such with the subset of IP ranges I care about.
 
-import json
+import array
 import logging
-import string
+import socket
+import struct
 import ip_match
 
+from bisect import bisect_right
+
+# Every response goes through the JSON encoder, so prefer simplejson and its C
+# speedups where the runtime has it installed.
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 # Assist the mapping process by converting the IP address string into a number
+#
+# Where the socket module offers it, let the C library's inet_pton () do the
+# parsing since that's far cheaper than splitting the string and converting
+# each field in Python. The GAE sandbox has historically been picky about what
+# parts of the socket module it exposes, so the plain Python version remains
+# as the fallback, and it's also used for anything inet_pton () rejects (such
+# as fields with leading zeroes) so the results don't change.
+
+try:
+    from socket import inet_pton, AF_INET
+except ImportError:
+    inet_pton = None
+
+# Every valid field of a dotted quad is one of only 256 strings, so a lookup
+# table is cheaper than handing each one to int () with all its generality.
+
+octets = dict ((str (value), value) for value in range (256))
 
 def stringip_to_number (text):
-    fields = string.split (text, '.')
+    if inet_pton:
+        try:
+            return struct.unpack ('!L', inet_pton (AF_INET, text)) [0]
+        except (socket.error, ValueError, TypeError):
+            pass
+
+    # A well-formed dotted quad is at most 15 characters with exactly four
+    # fields, so handle that case with straight-line code rather than the
+    # general loop; anything else, including fields that aren't in the octet
+    # table, keeps the old, more forgiving behaviour.
+
+    fields = text.split ('.')
+    if len (text) <= 15 and len (fields) == 4:
+        a, b, c, d = fields
+        try:
+            return (octets [a] << 24) + (octets [b] << 16) + (octets [c] << 8) + octets [d]
+        except KeyError:
+            pass
+
     total = 0
     for item in fields:
         total = (total << 8) + int (item)
@@ -43,26 +89,83 @@ ipv6_prefixes = {
     "2406:E000:": 2	# Snap! New Zealand
 };
 
-# Find any matching tuple inside the ip_match.ip_table list, which is sorted,
+# Since the prefixes are plain strings, index them by their text so a lookup
+# is a dict probe per distinct prefix length (of which there's currently only
+# one) rather than a startswith () against every entry; longer prefixes are
+# tried first so that a more specific entry wins.
+
+ipv6_index = dict ((prefix.upper (), isp) for prefix, isp in ipv6_prefixes.items ())
+ipv6_lengths = sorted (set (len (prefix) for prefix in ipv6_index), reverse = True)
+
+# The ip_match.ip_table list of (low, high, isp) tuples is sorted and the
+# ranges don't overlap, so split it once into parallel arrays; that lets the
+# lookup below bisect the range starts directly rather than picking through
+# a tuple object at every step.
+
+ip_low = array.array ('L', [item [0] for item in ip_match.ip_table])
+ip_high = array.array ('L', [item [1] for item in ip_match.ip_table])
+ip_isp = array.array ('l', [item [2] for item in ip_match.ip_table])
+
+# Find any matching range inside the ip_match.ip_table list, which is sorted,
 # and return the ISP number for it
 #
 # The remapping for loopback below is to help testing; since we don't have a
 # real IP to use in the local GAE dev environment, try the various known Steam
 # server IPs used by different ISPs to see if we can identify their netblocks.
+#
+# Clients tend to ask for several things in quick succession, so remember the
+# results for recently seen addresses. Rather than paying for LRU bookkeeping
+# the cache is just a dict which gets emptied whenever it fills up; plain dict
+# operations are atomic, so this is safe with threadsafe: true in app.yaml.
+
+netblock_cache = { }
+netblock_cache_size = 4096
 
 def find_netblock (ip):
     if ip == '127.0.0.1' or ip == "::1":
         ip = '203.167.129.4'
 
+    netblock = netblock_cache.get (ip)
+    if netblock is None:
+        netblock = match_netblock (ip)
+        if len (netblock_cache) >= netblock_cache_size:
+            netblock_cache.clear ()
+        netblock_cache [ip] = netblock
+
+    return netblock
+
+# Classify a whole batch of addresses at once, for bulk callers such as going
+# back over logged requests. This deliberately bypasses the cache above so a
+# big batch doesn't flush out the entries for clients actually talking to us;
+# repeats within the batch (which are common in logs) are only matched once.
+
+def find_netblocks (ips):
+    seen = { }
+    result = [ ]
+    for ip in ips:
+        netblock = seen.get (ip)
+        if netblock is None:
+            if ip == '127.0.0.1' or ip == "::1":
+                netblock = match_netblock ('203.167.129.4')
+            else:
+                netblock = match_netblock (ip)
+            seen [ip] = netblock
+
+        result.append (netblock)
+
+    return result
+
+def match_netblock (ip):
     ipType = type (ip)
     if ipType == str or ipType == unicode:
         if ':' in ip:   # look in IPv6 table.
             ip = ip.upper ()
-            for prefix in ipv6_prefixes.items ():
-                if ip.startswith (prefix [0]):
-                    return prefix [1]
+            for length in ipv6_lengths:
+                netblock = ipv6_index.get (ip [: length])
+                if netblock is not None:
+                    return netblock
 
-            logging.warning ('Unknown mapping for IPv6 address ' + ip)
+            logging.warning ('Unknown mapping for IPv6 address %s', ip)
             return - 1
 
         ipv4 = stringip_to_number (ip)
@@ -70,30 +173,15 @@ def find_netblock (ip):
         ipv4 = ip
 
     # Binary search or linear? Now the table is 1200 long, it's worth it to do
-    # a binary search.
-
-    table = ip_match.ip_table
-    low = 0
-    high = len (table) - 1
+    # a binary search, and the bisect module will do that in C for us over the
+    # separate arrays of range starts built above.
 
-    while low <= high:
-        mid = (low + high) / 2
-        item = table [mid]
-
-        if item [0] >= ipv4:
-            # Move down
-            high = mid - 1
-            continue
-
-        if item [1] >= ipv4:
-            # We have a match
-            return item [2]
-
-        # Move up
-        low = mid + 1
+    index = bisect_right (ip_low, ipv4) - 1
+    if index >= 0 and ip_high [index] >= ipv4:
+        return ip_isp [index]
 
     if type (ip) == str:
-        logging.warning ('Unknown mapping for IPv4 address ' + ip)
+        logging.warning ('Unknown mapping for IPv4 address %s', ip)
 
     return - 1
 
@@ -134,40 +222,50 @@ def notifyOwner (text, kind):
 # wrapping of the data, permitting the caller to ask for JSONP style.
 
 def send (handler, data):
-    cb = handler.request.get ('cb', '()')
-    if cb == '()':
+    cb = handler.request.GET.get ('cb')
+    if cb is None:
         handler.response.out.write (data)
         return
 
     # This header already exists in the collection so adjust rather than add
     handler.response.headers ['Content-Type'] = 'application/json; charset=utf-8'
 
+    text = json.dumps (data)
     if cb != '':
-        handler.response.out.write (cb + '(')
-    handler.response.out.write (json.dumps (data))
-    if cb != '':
-        handler.response.out.write (')')
+        text = '%s(%s)' % (cb, text)
+    handler.response.out.write (text)
 
-# All the data we care about, all in a dict, for various handlers to choose
-# from to render
+# Everything in the bundle other than the caller's country depends only on the
+# ISP entry and the defaults, none of which change once loaded, so work out the
+# result for each ISP up front rather than on every request.
+#
+# The strings are interned as well, since several ISPs expand to identical
+# rule text (for instance those sharing the same proxy server) and there's
+# no reason to hold a copy of each for every ISP in both API versions.
+#
+# Since ISP numbers are small, the results go in a list indexed by the ISP
+# number rather than a dict; the "Unknown" entry for - 1 conveniently lands in
+# the last slot, and it also fills any unused numbers in between.
 
-def bundle (self, isps, defaults, source = None):
-    if not source:
-        source = self.request.get ('ip', self.request.remote_addr)
-    netblock = find_netblock (source)
+def prebuild (isps, defaults):
+    bundles = [None] * (max (isps) + 2)
+    for netblock, isp in isps.items ():
+        result = { }
+        for key, value in build_isp (isp, defaults).items ():
+            if type (value) == str:
+                value = intern (value)
+            result [intern (key)] = value
 
-    # GAE actually includes a small amount of GeoIP itself; not what need for
-    # ISP selection, but interesting nonetheless (note: only in production,
-    # not in the dev server)
-    # http://code.google.com/appengine/docs/python/runtime.html#Request_Headers
+        bundles [netblock] = result
 
-    country = self.request.headers.get ('X-AppEngine-Country')
-    country = country or 'Unknown'
+    unknown = bundles [- 1]
+    for netblock in range (len (bundles)):
+        if bundles [netblock] is None:
+            bundles [netblock] = unknown
 
-    isp = isps.get (netblock)
-    if isp is None:
-        isp = isps.get (- 1)
+    return bundles
 
+def build_isp (isp, defaults):
     proxy = isp.get ('proxy')
 
     result = defaults.copy ()
@@ -202,7 +300,6 @@ def bundle (self, isps, defaults, source = None):
 
     result ['filterip'] = isp.get ('server')
     result ['ispname'] = isp.get ('name')
-    result ['country'] = country
 
     if proxy and proxyfilter and proxyallow:
         result ['proxy'] = proxy
@@ -216,5 +313,34 @@ def bundle (self, isps, defaults, source = None):
     if test:
         result ['test'] = test
 
-    logging.info (json.dumps (result))
+    return result
+
+# GAE actually includes a small amount of GeoIP itself; not what need for
+# ISP selection, but interesting nonetheless (note: only in production,
+# not in the dev server)
+# http://code.google.com/appengine/docs/python/runtime.html#Request_Headers
+
+def request_country (request):
+    return request.headers.get ('X-AppEngine-Country') or 'Unknown'
+
+# All the data we care about, all in a dict, for various handlers to choose
+# from to render
+
+def bundle (self, bundles, source = None):
+    if not source:
+        source = self.request.get ('ip', self.request.remote_addr)
+    netblock = find_netblock (source)
+
+    country = request_country (self.request)
+
+    if netblock >= len (bundles):
+        netblock = - 1
+
+    result = bundles [netblock].copy ()
+    result ['country'] = country
+
+    # Only pay for encoding the result a second time if it's going to be seen.
+
+    if logging.getLogger ().isEnabledFor (logging.INFO):
+        logging.info ('%s', json.dumps (result))
     return result
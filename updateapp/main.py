@@ -49,10 +49,10 @@
 
 import jinja2
 import os
+import urllib
 import webapp2
 import logging
 
-from google.appengine.ext.webapp import template
 from google.appengine.ext import db
 from google.appengine.api import users, xmpp, mail
 
@@ -234,15 +234,18 @@ new_isps = {
           'filter': '# No rules for AT&T, please suggest some!' }
 }
 
+# The per-ISP results for both versions of the API, worked out once up front.
+
+new_bundles = app_common.prebuild (new_isps, new_defaults)
+old_bundles = app_common.prebuild (old_isps.isps, old_defaults)
+
 # Simple utility cliches.
 
-def bundle (handler, isps = new_isps, defaults = new_defaults,
-            source = None):
-    return app_common.bundle (handler, isps, defaults, source)
+def bundle (handler, bundles = new_bundles, source = None):
+    return app_common.bundle (handler, bundles, source)
 
 def send (handler, data = None, key = None):
-    isps = new_isps
-    defaults = new_defaults
+    bundles = new_bundles
 
     # Decide what rules to serve. If I want to get fancy, I can
     # parse out the steam-limiter version from the User-Agent
@@ -256,23 +259,35 @@ def send (handler, data = None, key = None):
     if ver is None or ver == '0':
        agent = handler.request.headers ['User-Agent']
        if ver == '0' or agent.startswith ('steam-limiter/'):
-           isps = old_isps.isps
-           defaults = old_defaults
+           bundles = old_bundles
 
     # Allow manually forcing an IP to override the source host,
     # for testing purposes.
 
     alt_addr = handler.request.get ('ip', default_value = None)
     if not data:
-        data = bundle (handler, isps, defaults, alt_addr)
+        data = bundle (handler, bundles, alt_addr)
 
     if key:
         data = data.get (key)
     app_common.send (handler, data)
 
+# Templates are rendered with Jinja2, and since there are only a handful of
+# pages and nothing changes while an instance is running, they're all loaded
+# and compiled as the instance starts; rendering a page is then purely in
+# memory, without going near the files or the environment's own cache.
+
+here = os.path.dirname (__file__)
+jinja_env = jinja2.Environment (loader = jinja2.FileSystemLoader (here),
+                                autoescape = True, auto_reload = False)
+
+template_names = ('index.html', 'feedback.html', 'thanks.html',
+                  'uploadrule.html', 'default_error.html')
+templates = dict ((name, jinja_env.get_template (name))
+                  for name in template_names)
+
 def expand (handler, name, context):
-    path = os.path.join (os.path.dirname (__file__), name)
-    handler.response.out.write (template.render (path, context))
+    handler.response.out.write (templates [name].render (context))
 
 # The landing page for human readers to see
 
@@ -379,8 +394,7 @@ class UploadRuleHandler (webapp2.RequestHandler):
         rule = self.request.get ('filterrule')
         note = self.request.get ('content')
 
-        country = self.request.headers.get ('X-AppEngine-Country')
-        country = country or 'Unknown'
+        country = app_common.request_country (self.request)
 
         if rule != '':
             item = UploadedRule (ispName = isp, filterRule = rule, notes = note,
@@ -404,36 +418,54 @@ class TestReportHandler (webapp2.RequestHandler):
         test = self.request.get ('test')
         result = self.request.get ('result')
 
-        country = self.request.headers.get ('X-AppEngine-Country')
-        country = country or 'Unknown'
-
         notifyOwner (test + ' ==> ' + result + '\n', 'test')
         expand (self, 'thanks.html', { })
 
 # Custom 404 that suggests filing an issue rather than the default blank.
+#
+# Between crawlers and vulnerability scanners, stray URLs are a good chunk of
+# the traffic and the page has nothing dynamic in it, so it's rendered just
+# the once here rather than on every request.
+
+not_found_page = templates ['default_error.html'].render ({ })
 
 class NotFoundHandler (webapp2.RequestHandler):
     def get (self):
         self.error (404)
-        expand (self, 'default_error.html', { })
+        self.response.out.write (not_found_page)
 
 # Plumb up the GAE boilerplate with a mapping of URLs to handlers.
-
-app = webapp2.WSGIApplication ([('/', MainHandler),
-                                ('/latest', LatestHandler),
-                                ('/download', DownloadHandler),
-                                ('/ispname', IspHandler),
-                                ('/filterrule', FilterRuleHandler),
-                                ('/allow', AllowHostHandler),
-                                ('/all', BundleHandler),
-                                ('/feedback', FeedbackHandler),
-                                ('/uploadrule', UploadRuleHandler),
-                                ('/testreport', TestReportHandler),
-                                ('/.*', NotFoundHandler)],
-                               debug = True)
-
-def main ():
-    application.run ()
-
-if __name__ == '__main__':
-    main ()
+#
+# Rather than have webapp2 try each route's regex in turn, the paths are just
+# looked up directly; since all of them are literals, that's a single dict
+# lookup, with anything not in there going to the custom 404 handler. That
+# isn't a pattern route of its own, so there's no catch-all regex to evaluate
+# for the stray requests. Should a route with parameters ever be needed, it
+# can go in as a second level keyed on the first path segment.
+
+routes = (webapp2.SimpleRoute ('/', MainHandler),
+          webapp2.SimpleRoute ('/latest', LatestHandler),
+          webapp2.SimpleRoute ('/download', DownloadHandler),
+          webapp2.SimpleRoute ('/ispname', IspHandler),
+          webapp2.SimpleRoute ('/filterrule', FilterRuleHandler),
+          webapp2.SimpleRoute ('/allow', AllowHostHandler),
+          webapp2.SimpleRoute ('/all', BundleHandler),
+          webapp2.SimpleRoute ('/feedback', FeedbackHandler),
+          webapp2.SimpleRoute ('/uploadrule', UploadRuleHandler),
+          webapp2.SimpleRoute ('/testreport', TestReportHandler))
+
+route_map = dict ((route.template, route) for route in routes)
+not_found = webapp2.BaseRoute (None, NotFoundHandler)
+
+# Every route here is reached with a GET, so make sure each handler has one
+# as the instance starts, rather than finding out from a failed request.
+
+for route in routes + (not_found,):
+    assert callable (getattr (route.handler, 'get', None)), route.handler
+
+def match_route (router, request):
+    route = route_map.get (urllib.unquote (request.path), not_found)
+    return route, (), { }
+
+app = webapp2.WSGIApplication (routes, debug = True)
+app.router.set_matcher (match_route)